@@ -3,6 +3,7 @@
 import datetime
 import urllib.request
 import os
+import threading
 import traceback
 import logging
 
@@ -11,11 +12,20 @@ import tart.util.utc as utc
 
 
 class FileCache(sky_object.SkyObject):
+    # Seconds to wait for the download server
+    DOWNLOAD_TIMEOUT = 30
+    # How far back get_object() looks for a file when it may not download one
+    MAX_FALLBACK_DAYS = 7
+
     def __init__(self, name):
         sky_object.SkyObject.__init__(self, name)
         self.cache_root = "./orbit_data/{}".format(self.name)
         self.last_download_attempt = {}
         self.cache = {}
+        # When False, get_object() never downloads (another process fetches the files
+        # with fetch_file()), and a missing file is replaced by the latest earlier one.
+        self.download_enabled = True
+        self.lock = threading.Lock()
 
     def get_url(self, utc_date):
         doy = "%.3d" % utc_date.yday()
@@ -30,6 +40,10 @@ class FileCache(sky_object.SkyObject):
     def get_local_path(self, fname):
         return "{}/{}".format(self.cache_root, fname)
 
+    def have_file(self, date):
+        utc_date = utc.to_utc(date)
+        return os.path.isfile(self.get_local_path(self.get_local_filename(utc_date)))
+
     def create_object_from_file(self, local_path):
         # Override to create the object from the file
         pass
@@ -52,31 +66,55 @@ class FileCache(sky_object.SkyObject):
 
             logging.info("starting download ({} -> {}".format(url, local_file))
             self.last_download_attempt[url] = datetime.datetime.now()
-            dat = urllib.request.urlopen(url)
-            with open(local_file, 'wb') as w:
+            dat = urllib.request.urlopen(url, timeout=self.DOWNLOAD_TIMEOUT)
+            # Write to a temporary file and rename, so that other server processes
+            # and threads never see a partly written file.
+            tmp_file = f"{local_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'wb') as w:
                 w.write(dat.read())
                 w.close()
+            os.replace(tmp_file, local_file)
             logging.info("download complete")
         except Exception as err:
             logging.exception(err)
             self.last_download_attempt[url] = datetime.datetime.now()
             raise (err)
 
+    def fetch_file(self, date):
+        utc_date = utc.to_utc(date)
+        local_path = self.get_local_path(self.get_local_filename(utc_date))
+        if (os.path.isfile(local_path) is False):
+            self.download_file(self.get_url(utc_date), local_path)
+
     def get_object(self, date):
         utc_date = utc.to_utc(date)
 
         fname = self.get_local_filename(utc_date)
-        if fname in self.cache:
-            return self.cache[fname]
+        local_path = self.get_local_path(fname)
 
-        try:
-            local_path = self.get_local_path(fname)
+        if (self.download_enabled is False) and (os.path.isfile(local_path) is False):
+            for days in range(1, self.MAX_FALLBACK_DAYS + 1):
+                earlier = date - datetime.timedelta(days=days)
+                if self.have_file(earlier):
+                    return self.get_object(earlier)
+            raise RuntimeError(f"No {self.name} orbit data for {utc_date} "
+                               f"or the {self.MAX_FALLBACK_DAYS} days before")
 
+        try:
+            # Download without the lock, so a slow server does not hold up requests
+            # for files that are already cached.
             if (os.path.isfile(local_path) is False):
                 self.download_file(self.get_url(utc_date), local_path)
 
-            self.cache[fname] = self.create_object_from_file(local_path)
-            return self.cache[fname]
+            # Objects are cached by path and modification time, so a file is parsed once
+            # (even with concurrent requests), and parsed again only if it is replaced.
+            with self.lock:
+                key = (local_path, os.path.getmtime(local_path))
+                if key not in self.cache:
+                    for old_key in [k for k in self.cache if k[0] == local_path]:
+                        del self.cache[old_key]
+                    self.cache[key] = self.create_object_from_file(local_path)
+                return self.cache[key]
         except Exception as error:
             # Something went horribly wrong. print(out the exception and use data from a day ago)
             tb = traceback.format_exc()
@@ -0,0 +1,50 @@
+# Compiled numerical kernels for the object position server.
+#
+# (c) 2018-2023 Tim Molteno (tim@elec.ac.nz)
+#
+import math
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def transform(pos_eci, gst, sin_lat, cos_lat, sin_lon, cos_lon, obs_ecef, el_min):
+    '''
+        Convert an (N,3) array of ECI positions (meters) to horizontal coordinates
+        for an observer at obs_ecef. gst is the Greenwich sidereal time in radians.
+
+        Returns arrays of range (meters), elevation and azimuth (decimal degrees),
+        and a mask of the objects at or above el_min degrees elevation.
+    '''
+    n = pos_eci.shape[0]
+    r = np.empty(n)
+    el = np.empty(n)
+    az = np.empty(n)
+    mask = np.empty(n, dtype=np.bool_)
+
+    c = math.cos(gst)
+    s = math.sin(gst)
+    for i in range(n):
+        # ECI -> ECEF, relative to the observer
+        x = c*pos_eci[i, 0] + s*pos_eci[i, 1] - obs_ecef[0]
+        y = -s*pos_eci[i, 0] + c*pos_eci[i, 1] - obs_ecef[1]
+        z = pos_eci[i, 2] - obs_ecef[2]
+
+        # ECEF -> ENU
+        e = -sin_lon*x + cos_lon*y
+        nn = -cos_lon*sin_lat*x - sin_lon*sin_lat*y + cos_lat*z
+        u = cos_lon*cos_lat*x + sin_lon*cos_lat*y + sin_lat*z
+
+        r[i] = math.sqrt(e*e + nn*nn + u*u)
+        el[i] = math.degrees(math.asin(u / r[i]))
+        a = math.degrees(math.atan2(e, nn))
+        if a < 0.0:
+            a += 360.0
+        az[i] = a
+        mask[i] = el[i] >= el_min
+    return r, el, az, mask
+
+
+# Compile (or load from the cache) at import, rather than stalling the first request.
+transform(np.zeros((1, 3)), 0.0, 0.0, 1.0, 0.0, 1.0, np.ones(3), 0.0)
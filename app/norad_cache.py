@@ -2,19 +2,64 @@
 #
 # (c) 2013-2023 Tim Molteno (tim@elec.ac.nz)
 #
+import concurrent.futures
+import logging
+import re
+import threading
+from functools import lru_cache
+
 import file_cache
+import kernels
+import observer
+import sky_object
 
-from sgp4.earth_gravity import wgs84
-from sgp4.io import twoline2rv
+from sgp4.api import Satrec, SatrecArray, WGS84, accelerated
 
 from tart.imaging import location
 
 import numpy as np
 
+if not accelerated:
+    logging.warning("sgp4 C++ extension not available. Using the (much slower) python propagator")
+
+
+def eci_to_ecef_batch(date, pos):
+    '''
+        Rotate an (N,3) array of ECI positions into ECEF. The rotation by the
+        Greenwich sidereal time is the same for every row, so it is built once.
+    '''
+    theta = observer.get_gst(date)
+    c, s = np.cos(theta), np.sin(theta)
+    R = np.array([[c, s, 0.0],
+                  [-s, c, 0.0],
+                  [0.0, 0.0, 1.0]])
+    return pos @ R.T
+
+
+def ecef_to_horizontal_batch(obs, ecef):
+    '''
+        Convert an (N,3) array of ECEF positions to horizontal coordinates seen by the
+        observer (an ObserverContext).
+        Returns arrays of range (meters), elevation and azimuth (decimal degrees).
+    '''
+    sin_lat, cos_lat = obs.sin_lat, obs.cos_lat
+    sin_lon, cos_lon = obs.sin_lon, obs.cos_lon
+    M = np.array([[-sin_lon, cos_lon, 0.0],
+                  [-cos_lon*sin_lat, -sin_lon*sin_lat, cos_lat],
+                  [cos_lon*cos_lat, sin_lon*cos_lat, sin_lat]])
+    diff = ecef - obs.obs_ecef
+    enu = np.einsum('ij,nj->ni', M, diff)
+
+    r = np.linalg.norm(enu, axis=1)
+    el = np.degrees(np.arcsin(enu[:, 2] / r))
+    az = np.degrees(np.arctan2(enu[:, 0], enu[:, 1]))
+    az = np.where(az < 0.0, az + 360.0, az)
+    return r, el, az
+
 
 '''
     A class to predict positions from an Ephemeris (the collective noun is Ephemerides).
-    
+    Sp4Ephemerides no longer uses these to propagate, they are kept as a per-satellite view.
 '''
 class Sp4Ephemeris:
     def __init__(self, name, sv):
@@ -22,8 +67,8 @@ class Sp4Ephemeris:
         self.sv = sv
 
     def get_position(self, date):
-        position, velocity = self.sv.propagate(
-            date.year, date.month, date.day, date.hour, date.minute, date.second)
+        jd, fr = observer.get_jd_fr(date)
+        e, position, velocity = self.sv.sgp4(jd, fr)
         vel = [velocity[0]*1000.0, velocity[1]*1000.0, velocity[2]*1000.0]
         pos = location.eci_to_ecef(
             date, position[0]*1000.0, position[1]*1000.0, position[2]*1000.0)
@@ -35,53 +80,197 @@ class Sp4Ephemeris:
 
 
 '''
-    A class to hold a group of ephemeris, and to calculate positions from the entire group
+    A class to hold a group of ephemeris, and to calculate positions from the entire group.
+    The group is stored as parallel arrays of names, satellite records and flux, with all
+    the records in one SatrecArray so they can be propagated together.
 '''
 class Sp4Ephemerides:
     def __init__(self, local_path, jansky, name_list=None):
         self.jansky = jansky
-        self.satellites = []
-        f = open(local_path, "r")
-        lines = f.readlines()
-        for i, l in enumerate(lines):
-            # print(i, l)
-            if (i % 3 == 0):
-                name = l.strip()
-
-            if (i % 3 == 1):
-                line1 = l.strip()
-
-            if (i % 3 == 2):
-                line2 = l.strip()
-                sv = twoline2rv(line1, line2, wgs84)
-                if name_list is None:
-                    self.satellites.append(Sp4Ephemeris(name, sv))
-                else:
-                    # Check that name is in the list.
-                    for n in name_list:
-                        if n in name:
-                            self.satellites.append(Sp4Ephemeris(name, sv))
+        names = []
+        satrecs = []
+        # Match any of the names in name_list with one regular expression search.
+        # An empty list matches nothing (an empty pattern would match everything).
+        name_re = None
+        if name_list is not None:
+            name_re = re.compile('|'.join(re.escape(n) for n in name_list) or '(?!)')
+
+        with open(local_path, "r") as f:
+            lines = f.read().rstrip().splitlines()
+
+        # Each element set is three lines: name, line 1, line 2. Satrec.twoline2rv()
+        # does not check the format, so reject a malformed file (e.g. an error page)
+        # here, and FileCache falls back to the previous day's file.
+        if len(lines) == 0 or len(lines) % 3 != 0:
+            raise ValueError(f"{local_path}: {len(lines)} lines is not a list of element sets")
+        for name, line1, line2 in zip(lines[0::3], lines[1::3], lines[2::3]):
+            name = name.strip()
+            line1 = line1.strip()
+            line2 = line2.strip()
+            if not (line1.startswith('1 ') and line2.startswith('2 ') and
+                    line1[2:7] == line2[2:7]):
+                raise ValueError(f"{local_path}: malformed element set '{name}'")
+            # Check that name is in the list.
+            if name_re is None or name_re.search(name):
+                names.append(name)
+                satrecs.append(Satrec.twoline2rv(line1, line2, WGS84))
+
+        self.set_satellites(names, satrecs, np.full(len(names), float(jansky)))
+
+    def set_satellites(self, names, satrecs, jy):
+        self.names = np.array(names, dtype=object)
+        self.jy = jy
+        self._satrecs = satrecs
+        self._arr = SatrecArray(satrecs)
+        # Requests for the same instant (e.g. /catalog and /position, or repeated
+        # polling) share one propagation. The memo goes with this object, so it is
+        # discarded when the TLEs are reloaded.
+        self._propagate_memo = lru_cache(maxsize=256)(self._propagate)
+
+    @property
+    def satellites(self):
+        return [Sp4Ephemeris(name, sv) for name, sv in zip(self.names, self._satrecs)]
+
+    def propagate(self, jd, fr):
+        '''
+            Propagate all satellites to the julian date jd + fr. Returns the sgp4 error codes,
+            and the ECI positions and velocities (in meters and meters per second) as (N,3) arrays.
+            The results are memoized, so the returned arrays must not be modified.
+        '''
+        return self._propagate_memo(jd, fr)
+
+    def _propagate(self, jd, fr):
+        e, r, v = self._arr.sgp4(np.array([jd]), np.array([fr]))
+        return e[:, 0], r[:, 0, :]*1000.0, v[:, 0, :]*1000.0
+
+    def propagate_bulk(self, jd, fr):
+        '''
+            Propagate all satellites to each of the T julian dates in the arrays jd + fr,
+            in one call. Returns the sgp4 error codes (N,T) and the ECI positions and
+            velocities as (N,T,3) arrays.
+        '''
+        e, r, v = self._arr.sgp4(jd, fr)
+        return e, r*1000.0, v*1000.0
+
+    def get_positions_batch(self, date):
+        '''
+            Return the names, ECEF positions, velocities and flux (jansky) of the satellites
+            that propagated without error, as a list, two (N,3) arrays and an (N,) array.
+        '''
+        jd, fr = observer.get_jd_fr(date)
+        e, pos, vel = self.propagate(jd, fr)
+        ok = (e == 0)
+        ecef = eci_to_ecef_batch(date, pos[ok])
+        return self.names[ok].tolist(), ecef, vel[ok], self.jy[ok]
 
     def get_positions(self, date):
         ret = []
-        for sv in self.satellites:
-            p, v = sv.get_position(date)
-            ret.append({'name': sv.name, 'ecef': p,
-                       'ecef_dot': v, 'jy': self.jansky})
+        names, ecef, vel, jy = self.get_positions_batch(date)
+        for name, p, v, _jy in zip(names, ecef.tolist(), vel.tolist(), jy.tolist()):
+            ret.append({'name': name, 'ecef': p,
+                       'ecef_dot': v, 'jy': _jy})
         return ret
 
-    def get_az_el(self, date, lat, lon, alt, elevation):
-        ret = []
-        loc = location.Location(lat, lon, alt)
-        # print("Location {}".format(loc))
-
-        for sv in self.satellites:
-            _r, _el, _az = sv.get_az_el(date, loc)
-            el, az = np.round([_el.to_degrees(), _az.to_degrees()], decimals=6)
-            r = np.round(_r, decimals=1)
-            if (el >= elevation):
-                ret.append({'name': sv.name, 'r': r, 'el': el,
-                           'az': az, 'jy': self.jansky})
+    def az_el_result(self, indices, rng, elev, azim):
+        '''
+            The AzElResult for the satellites at indices.
+        '''
+        return sky_object.AzElResult(self.names[indices], rng[indices], elev[indices],
+                                     azim[indices], self.jy[indices])
+
+    def get_az_el(self, obs, elevation):
+        e, pos, vel = self.propagate(obs.jd, obs.fr)
+        # Satellites that sgp4 could not propagate have NaN positions. Keep them out of
+        # the kernel, as fastmath assumes there are no NaNs.
+        ok = np.flatnonzero(e == 0)
+        rng, elev, azim, mask = kernels.transform(
+            pos[ok], obs.gst, obs.sin_lat, obs.cos_lat, obs.sin_lon, obs.cos_lon,
+            obs.obs_ecef, float(elevation))
+        selected = ok[mask]
+        return sky_object.AzElResult(self.names[selected], rng[mask], elev[mask],
+                                     azim[mask], self.jy[selected])
+
+    def get_az_el_bulk(self, obs_list, elevation):
+        '''
+            As get_az_el() for a list of observer contexts that share a location but have
+            different dates. Returns a list of AzElResults, one per date.
+        '''
+        t = len(obs_list)
+        jd = np.fromiter((obs.jd for obs in obs_list), dtype=float, count=t)
+        fr = np.fromiter((obs.fr for obs in obs_list), dtype=float, count=t)
+
+        # Only propagate each distinct date once
+        dates, inverse = np.unique(np.stack([jd, fr], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        e, pos, vel = self.propagate_bulk(np.ascontiguousarray(dates[:, 0]),
+                                          np.ascontiguousarray(dates[:, 1]))
+        e, pos = e[:, inverse], pos[:, inverse]
+
+        # One ECI -> ECEF rotation per date
+        gst = np.array([obs.gst for obs in obs_list])
+        c, s = np.cos(gst), np.sin(gst)
+        zero, one = np.zeros_like(gst), np.ones_like(gst)
+        R = np.stack([np.stack([c, s, zero], axis=-1),
+                      np.stack([-s, c, zero], axis=-1),
+                      np.stack([zero, zero, one], axis=-1)], axis=1)
+        ecef = np.einsum('tij,ntj->nti', R, pos)
+
+        n = e.shape[0]
+        rng, elev, azim = [x.reshape(n, t) for x in
+                           ecef_to_horizontal_batch(obs_list[0], ecef.reshape(-1, 3))]
+        mask = (elev >= elevation) & (e == 0)
+
+        return [self.az_el_result(np.flatnonzero(mask[:, j]), rng[:, j], elev[:, j], azim[:, j])
+                for j in range(t)]
+
+
+
+'''
+    All the satellites of several Sp4Ephemerides, in a single SatrecArray so that they
+    are propagated together.
+'''
+class CombinedEphemerides(Sp4Ephemerides):
+    def __init__(self, ephemerides):
+        satrecs = []
+        for eph in ephemerides:
+            satrecs += eph._satrecs
+        self.set_satellites(np.concatenate([eph.names for eph in ephemerides]), satrecs,
+                            np.concatenate([eph.jy for eph in ephemerides]))
+
+
+'''
+    Base class for objects that provide predictions from the Sp4Ephemerides returned by
+    their get_object(date) method.
+'''
+class EphemerisSource(sky_object.SkyObject):
+
+    def get_positions_batch(self, date):
+        eph = self.get_object(date)
+        return eph.get_positions_batch(date)
+
+    def get_positions(self, date):
+        eph = self.get_object(date)
+        ret = eph.get_positions(date)
+        return ret
+
+    def get_az_el(self, obs, elevation):
+        eph = self.get_object(obs.date)
+        ret = eph.get_az_el(obs, elevation)
+        return ret
+
+    def get_az_el_bulk(self, obs_list, elevation):
+        # The ephemerides file is chosen by UTC day, so group the dates by day and
+        # look up the file once per day.
+        days = {}
+        for i, obs in enumerate(obs_list):
+            days.setdefault(obs.date.date(), []).append(i)
+
+        ret = [None]*len(obs_list)
+        for indices in days.values():
+            eph = self.get_object(obs_list[indices[0]].date)
+            cats = eph.get_az_el_bulk([obs_list[i] for i in indices], elevation)
+            for i, cat in zip(indices, cats):
+                ret[i] = cat
         return ret
 
 
@@ -94,21 +283,43 @@ class Sp4Ephemerides:
 
     Only one file is downloaded per day, and all orbital predictions are made from this file.
 '''
-class EphemerisFileCache(file_cache.FileCache):
+class EphemerisFileCache(file_cache.FileCache, EphemerisSource):
 
     def __init__(self, name):
         file_cache.FileCache.__init__(self, name)
 
-    def get_positions(self, date):
-        eph = self.get_object(date)
-        ret = eph.get_positions(date)
-        return ret
 
-    def get_az_el(self, date, lat, lon, alt, elevation):
-        eph = self.get_object(date)
-        ret = eph.get_az_el(date, lat, lon, alt, elevation)
-        return ret
 
+'''
+    Several ephemeris file caches (e.g. SBAS, GPS, Galileo and Beidou) combined, so that
+    a request propagates all their satellites in one call. The combination is rebuilt
+    whenever one of the caches returns a different object (a new day or new file).
+'''
+class CombinedCatalog(EphemerisSource):
+    MAX_COMBINED = 8
+
+    # When files are missing, fetching from the caches means downloading a file each,
+    # do those concurrently. (Propagation itself holds the GIL in sgp4, so there is no
+    # gain from threads there).
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+    def __init__(self, caches):
+        EphemerisSource.__init__(self, "combined")
+        self.caches = caches
+        self.combined = {}
+        self.lock = threading.Lock()
+
+    def get_object(self, date):
+        if all(cache.have_file(date) for cache in self.caches):
+            key = tuple(cache.get_object(date) for cache in self.caches)
+        else:
+            key = tuple(self.pool.map(lambda cache: cache.get_object(date), self.caches))
+        with self.lock:
+            if key not in self.combined:
+                if len(self.combined) >= self.MAX_COMBINED:
+                    del self.combined[next(iter(self.combined))]
+                self.combined[key] = CombinedEphemerides(key)
+            return self.combined[key]
 
 
 # Space Based Augmentation Satellites (SBAS)
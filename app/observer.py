@@ -0,0 +1,58 @@
+# The observer (time and place) of a request.
+#
+# (c) 2018-2023 Tim Molteno (tim@elec.ac.nz)
+#
+from functools import lru_cache
+
+from sgp4.api import jday
+from tart.imaging import location
+from tart.util import angle
+
+import numpy as np
+
+
+@lru_cache(maxsize=4096)
+def get_jd_fr(date):
+    '''
+        Split a UTC date into the (whole, fractional) julian date pair used by sgp4.
+        Memoized, as every catalogue in a request asks for the same date.
+    '''
+    return jday(date.year, date.month, date.day, date.hour, date.minute,
+                date.second + date.microsecond*1e-6)
+
+
+@lru_cache(maxsize=4096)
+def get_gst(date):
+    '''
+        Greenwich sidereal time (radians) at the date.
+    '''
+    return location.Location.GST(date).to_rad()
+
+
+@lru_cache(maxsize=1024)
+def get_location(lat_deg, lon_deg, alt):
+    '''
+        The observer Location. Memoized, as the same observer makes many requests.
+        Keyed by degrees, as angle objects are not hashable.
+    '''
+    return location.Location(angle.from_dms(lat_deg), angle.from_dms(lon_deg), alt)
+
+
+'''
+    Everything about the observer that is needed to convert positions to local
+    horizontal coordinates. This depends only on the date and the observer location,
+    so it is calculated once per request and shared by all the catalogues.
+'''
+class ObserverContext:
+    def __init__(self, date, lat, lon, alt):
+        self.date = date
+        self.jd, self.fr = get_jd_fr(date)
+        self.gst = get_gst(date)
+
+        self.location = get_location(lat.to_degrees(), lon.to_degrees(), alt)
+
+        self.sin_lat = self.location.lat.sin()
+        self.cos_lat = self.location.lat.cos()
+        self.sin_lon = self.location.lon.sin()
+        self.cos_lon = self.location.lon.cos()
+        self.obs_ecef = np.array(self.location.get_ecef())
@@ -4,17 +4,28 @@
 
 
 from flask import Flask
-from flask import jsonify, request
+from flask import Response, request
 from flask_cors import CORS, cross_origin
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+import orjson
+
 import tart.util.utc as utc
 from tart.util import angle
+import atexit
+import datetime
+import fcntl
+import os
+import random
+import threading
+import time
 import traceback
 
 import norad_cache
 from dateutil import parser
+import observer
+import sky_object
 import sun_object
 
 waas_cache = norad_cache.NORADCache()
@@ -23,6 +34,14 @@ gps_cache = norad_cache.GPSCache()
 galileo_cache = norad_cache.GalileoCache()
 beidou_cache = norad_cache.BeidouCache()
 
+# All the satellites, propagated together
+satellites = norad_cache.CombinedCatalog(
+    [waas_cache, gps_cache, galileo_cache, beidou_cache])
+# Requests never wait for a download. The refresh_catalogs() thread of one server
+# process fetches the files, and until then requests use the previous day's file.
+for cache in satellites.caches:
+    cache.download_enabled = False
+
 sun = sun_object.SunObject()
 
 
@@ -61,13 +80,23 @@ def get_required_parameter(request, param_name):
         raise Exception("Missing Required Parameter '{}'".format(param_name))
 
 
+def json_response(obj):
+    # orjson is much faster than jsonify() for the long lists of floats returned here
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY),
+                    mimetype='application/json')
+
+
 def get_catalog_list(date, lat, lon, alt, elevation):
-    cat = waas_cache.get_az_el(date, lat, lon, alt, elevation)
-    cat += gps_cache.get_az_el(date, lat, lon, alt, elevation)
-    cat += galileo_cache.get_az_el(date, lat, lon, alt, elevation)
-    cat += beidou_cache.get_az_el(date, lat, lon, alt, elevation)
-    cat += sun.get_az_el(date, lat, lon, alt, elevation)
-    return cat
+    obs = observer.ObserverContext(date, lat, lon, alt)
+    cat = sky_object.AzElResult.concatenate([satellites.get_az_el(obs, elevation),
+                                             sun.get_az_el(obs, elevation)])
+    return cat.to_list()
+
+
+def get_bulk_catalog_list(date_list, lat, lon, alt, elevation):
+    obs_list = [observer.ObserverContext(d, lat, lon, alt) for d in date_list]
+    sources = [src.get_az_el_bulk(obs_list, elevation) for src in [satellites, sun]]
+    return [sky_object.AzElResult.concatenate(cats).to_list() for cats in zip(*sources)]
 
 
 # sudo pip install Flask
@@ -84,8 +113,9 @@ if not app.debug:
     log_handler = RotatingFileHandler(
         "catalog.log", mode='a', maxBytes=100000,
         backupCount=5, encoding=None, delay=False)
-    log_handler.setLevel(logging.WARNING)
+    log_handler.setLevel(logging.INFO)
     app.logger.addHandler(log_handler)
+    app.logger.setLevel(logging.INFO)
 
 
 @app.errorhandler(Exception)
@@ -123,7 +153,7 @@ def get_catalog():
         elevation = 0.0
     alt = 0.0
     ret = get_catalog_list(date, lat, lon, alt, elevation)
-    return jsonify(ret)
+    return json_response(ret)
 
 
 """
@@ -142,17 +172,13 @@ def get_catalog():
 def get_pos():
     try:
         date = parse_request_date(request)
-        ret = waas_cache.get_positions(date)
-        ret += gps_cache.get_positions(date)
-        # ret += extra_cache.get_positions(date)
-        ret += galileo_cache.get_positions(date)
-        ret += beidou_cache.get_positions(date)
-        return jsonify(ret)
+        ret = satellites.get_positions(date)
+        return json_response(ret)
     except Exception as err:
         tb = traceback.format_exc()
         ret = "Exception: {}".format(err)
         lines = tb.split("\n")
-        return jsonify({"error": ret, "traceback": lines})
+        return json_response({"error": ret, "traceback": lines})
 
 
 """
@@ -206,15 +232,89 @@ def get_bulk_az_el():
 
         date_list = [parse_date(ts) for ts in dates_param]
         res['dates'] = [d.isoformat() for d in date_list]
-        res['az_el'] = [get_catalog_list(d, lat, lon, alt, elevation) for d in date_list]
+        res['az_el'] = get_bulk_catalog_list(date_list, lat, lon, alt, elevation)
 
-        return jsonify(res)
+        return json_response(res)
 
     except Exception as err:
         tb = traceback.format_exc()
         ret = f"Exception: {err}"
         lines = tb.split("\n")
-        return jsonify({"error": ret, "traceback": lines, "param": f"{res}"})
+        return json_response({"error": ret, "traceback": lines, "param": f"{res}"})
+
+
+# Matches the interval at which FileCache will retry a failed download
+REFRESH_RETRY_SECONDS = 3600
+# How often the other server processes look for the files the refresher downloaded
+REFRESH_CHECK_SECONDS = 300
+# Spread the daily refresh, so that servers don't all hit the download sites at once
+REFRESH_JITTER_SECONDS = 300
+REFRESH_LOCK_FILE = "./orbit_data/refresh.lock"
+
+
+def acquire_refresh_lock():
+    """
+        Only one server process (e.g. of the gunicorn workers) downloads the orbit files.
+        Returns the open lock file if this process holds the lock (it is held as long
+        as the file stays open), or None if another process has it.
+    """
+    os.makedirs(os.path.dirname(REFRESH_LOCK_FILE), exist_ok=True)
+    lock_file = open(REFRESH_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return lock_file
+    except OSError:
+        lock_file.close()
+        return None
+
+
+def fetch_catalogs(date):
+    """
+        Download the orbit files for the date that are not on disk yet, concurrently.
+    """
+    def fetch(cache):
+        try:
+            cache.fetch_file(date)
+        except Exception as err:
+            app.logger.error(err)
+    list(satellites.pool.map(fetch, satellites.caches))
+
+
+def refresh_catalogs():
+    """
+        Fetch the orbit files when the server starts, and each new day's files just
+        after UTC midnight, and load them, so that requests don't wait for the downloads
+        and parsing. Retries until they succeed. Only the process with the refresh lock
+        downloads, the others wait for the files to appear and load them.
+    """
+    lock_file = None
+    while True:
+        while True:
+            date = utc.now()
+            if lock_file is None:
+                lock_file = acquire_refresh_lock()
+            if lock_file is not None:
+                fetch_catalogs(date)
+            if all(cache.have_file(date) for cache in satellites.caches):
+                satellites.get_object(date)
+                break
+            if lock_file is not None:
+                app.logger.warning(f"Orbit files for {date.date()} not available yet. Retrying.")
+                time.sleep(REFRESH_RETRY_SECONDS)
+            else:
+                time.sleep(REFRESH_CHECK_SECONDS)
+        app.logger.info(f"Orbit data for {date.date()} ready")
+
+        now = utc.now()
+        tomorrow = (now + datetime.timedelta(days=1)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        time.sleep((tomorrow - now).total_seconds() + 60.0 +
+                   random.uniform(0, REFRESH_JITTER_SECONDS))
+
+
+# In a thread, so the server can answer requests (e.g. health checks) while it loads.
+threading.Thread(target=refresh_catalogs, name="refresh_catalogs", daemon=True).start()
+atexit.register(lambda: app.logger.info("Object position server shutting down"))
 
 
 if __name__ == '__main__':
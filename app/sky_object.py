@@ -1,5 +1,42 @@
 # Author Tim Molteno tim@elec.ac.nz (c) 2013-2023
 
+import numpy as np
+
+
+'''
+    A catalogue of objects in local horizontal coordinates, stored as parallel arrays
+    of names, range (meters), elevation and azimuth (decimal degrees) and flux (jansky).
+    This is what get_az_el() returns. The list of dicts sent to clients is only built
+    by to_list() when the response is encoded.
+'''
+class AzElResult:
+
+    def __init__(self, names, r, el, az, jy):
+        self.names = np.asarray(names, dtype=object)
+        self.r = np.asarray(r, dtype=float)
+        self.el = np.asarray(el, dtype=float)
+        self.az = np.asarray(az, dtype=float)
+        self.jy = np.asarray(jy, dtype=float)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def concatenate(results):
+        return AzElResult(np.concatenate([x.names for x in results]),
+                          np.concatenate([x.r for x in results]),
+                          np.concatenate([x.el for x in results]),
+                          np.concatenate([x.az for x in results]),
+                          np.concatenate([x.jy for x in results]))
+
+    def to_list(self):
+        r = np.round(self.r, decimals=1).tolist()
+        el = np.round(self.el, decimals=6).tolist()
+        az = np.round(self.az, decimals=6).tolist()
+        return [{'name': name, 'r': _r, 'el': _el, 'az': _az, 'jy': _jy}
+                for name, _r, _el, _az, _jy in zip(self.names.tolist(), r, el, az, self.jy.tolist())]
+
+
 class SkyObject:
 
     def __init__(self, name):
@@ -9,6 +46,9 @@ class SkyObject:
         raise Exception(
             "This cache object must have an overriden get_positions() method")
 
-    def get_az_el(self, date, lat, lon, alt):
+    def get_az_el(self, obs, elevation):
         raise Exception(
             "This cache object must have an overriden get_az_el() method")
+
+    def get_az_el_bulk(self, obs_list, elevation):
+        return [self.get_az_el(obs, elevation) for obs in obs_list]
@@ -1,6 +1,6 @@
 # (c) 2018-2023 Tim Molteno (tim@elec.ac.nz)
 
-from tart.imaging import location, sun
+from tart.imaging import sun
 import sky_object
 import numpy as np
 
@@ -9,17 +9,36 @@ class SunObject(sky_object.SkyObject):
 
     def __init__(self):
         sky_object.SkyObject.__init__(self, "Sun")
+        self.sun = sun.Sun()
+
+    def get_az_el(self, obs, elevation):
+        return self.get_az_el_bulk([obs], elevation)[0]
+
+    def get_az_el_bulk(self, obs_list, elevation):
+        if len(obs_list) == 0:
+            return []
+        # Only the RA and declination are calculated per date. The conversion to
+        # horizontal uses the sidereal time already in each observer context, and
+        # is done for all the dates at once.
+        radec = [self.sun.radec(obs.date) for obs in obs_list]
+        ra = np.array([r.to_rad() for r, d in radec])
+        dec = np.array([d.to_rad() for r, d in radec])
+        gst = np.array([obs.gst for obs in obs_list])
+
+        obs = obs_list[0]
+        lha = gst + obs.location.lon.to_rad() - ra
+        sin_el = np.sin(dec)*obs.sin_lat + np.cos(dec)*obs.cos_lat*np.cos(lha)
+        el = np.degrees(np.arcsin(sin_el))
+        az = np.degrees(np.arctan2(-np.sin(lha)*np.cos(dec),
+                                   (np.sin(dec) - obs.sin_lat*sin_el) / obs.cos_lat))
+        az = np.where(az < 0.0, az + 360.0, az)
 
-    def get_az_el(self, utc_date, lat, lon, alt, elevation):
-        s = sun.Sun()
-        loc = location.Location(lat, lon, alt=alt)
-        ra, decl = s.radec(utc_date)
-        _el, _az = loc.equatorial_to_horizontal(utc_date, ra, decl)
-        el, az = np.round([_el.to_degrees(), _az.to_degrees()], decimals=6)
         ret = []
-        if (el > elevation):
-            ret.append({'name': 'sun', 'r': 1e10,
-                       'el': el, 'az': az, 'jy': 10000.0})
+        for _el, _az in zip(el.tolist(), az.tolist()):
+            if (_el > elevation):
+                ret.append(sky_object.AzElResult(['sun'], [1e10], [_el], [_az], [10000.0]))
+            else:
+                ret.append(sky_object.AzElResult([], [], [], [], []))
         return ret
 
 
@@ -27,6 +46,9 @@ if __name__ == "__main__":
     import tart.util.utc as utc
     import tart.util.angle as angle
 
+    import observer
+
     cache = SunObject()
-    print(cache.get_az_el(utc.now(), lat=angle.from_dms(-45.86391200),
-          lon=angle.from_dms(170.51348452), alt=46.5))
+    obs = observer.ObserverContext(utc.now(), lat=angle.from_dms(-45.86391200),
+                                   lon=angle.from_dms(170.51348452), alt=46.5)
+    print(cache.get_az_el(obs, elevation=-90.0).to_list())
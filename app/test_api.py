@@ -37,6 +37,12 @@ class TestCatalog(unittest.TestCase):
         with self.assertRaises(ValueError):
             ans = self.request(t + dt)
 
+    def test_bulk_no_dates(self):
+        json_data = {"lat": -45.87, "lon": 170.6, "alt": 0, "dates": []}
+        r = requests.post('{}/bulk_az_el'.format(self.server), json=json_data)
+        ans = json.loads(r.text)
+        self.assertEqual(ans['az_el'], [])
+
     def test_speed(self):
         t = datetime.datetime.utcnow()  # utc.utc_datetime(2002, 10, 31, 2, 2, 2)
 
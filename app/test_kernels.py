@@ -0,0 +1,125 @@
+# (c) 2018-2023 Tim Molteno (tim@elec.ac.nz)
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+import tart.util.utc as utc
+from tart.imaging import location, sun
+from tart.util import angle
+
+import kernels
+import norad_cache
+import observer
+import sun_object
+
+# A valid GPS-like satellite, and a satellite that decayed long before DATE (sgp4 error 1)
+TLE = """GPS BIIR 0 (PRN 00)
+1 41000U          24341.50000000  .00000000  00000-0  10000-4 0    02
+2 41000  55.0000   0.0000 0100000   0.0000   0.0000  2.00560000    01
+DECAYED
+1 06251U 62025E   06176.82412014  .00008885  00000-0  12808-3 0  3985
+2 06251  58.0579  54.0425 0030035 139.1568 221.1854 15.56387291  6774
+"""
+
+DATE = utc.utc_datetime(2024, 12, 7, 9, 25, 55)
+
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.lat = angle.from_dms(-45.85)
+        self.lon = angle.from_dms(170.54)
+        self.obs = observer.ObserverContext(DATE, self.lat, self.lon, 46.5)
+        self.loc = location.Location(self.lat, self.lon, 46.5)
+
+        rng = np.random.default_rng(42)
+        # Points between low earth orbit and geostationary distance
+        direction = rng.normal(size=(50, 3))
+        direction /= np.linalg.norm(direction, axis=1)[:, None]
+        self.pos_eci = direction * rng.uniform(7.0e6, 4.2e7, size=(50, 1))
+
+    def scalar_horizontal(self, p):
+        x, y, z = location.eci_to_ecef(DATE, *p)
+        return self.loc.ecef_to_horizontal(x, y, z)
+
+    def test_transform(self):
+        obs = self.obs
+        r, el, az, mask = kernels.transform(self.pos_eci, obs.gst, obs.sin_lat, obs.cos_lat,
+                                            obs.sin_lon, obs.cos_lon, obs.obs_ecef, 10.0)
+        for i, p in enumerate(self.pos_eci.tolist()):
+            _r, _el, _az = self.scalar_horizontal(p)
+            self.assertAlmostEqual(r[i], _r, delta=1e-3)
+            self.assertAlmostEqual(el[i], _el.to_degrees(), places=6)
+            self.assertAlmostEqual(az[i], _az.to_degrees(), places=6)
+            self.assertEqual(mask[i], el[i] >= 10.0)
+
+    def test_ecef_to_horizontal_batch(self):
+        ecef = norad_cache.eci_to_ecef_batch(DATE, self.pos_eci)
+        r, el, az = norad_cache.ecef_to_horizontal_batch(self.obs, ecef)
+        for i, p in enumerate(self.pos_eci.tolist()):
+            np.testing.assert_allclose(ecef[i], location.eci_to_ecef(DATE, *p), atol=1e-3)
+            _r, _el, _az = self.scalar_horizontal(p)
+            self.assertAlmostEqual(r[i], _r, delta=1e-3)
+            self.assertAlmostEqual(el[i], _el.to_degrees(), places=6)
+            self.assertAlmostEqual(az[i], _az.to_degrees(), places=6)
+
+    def test_sun_get_az_el_bulk(self):
+        dates = [DATE + datetime.timedelta(hours=h) for h in range(0, 24, 5)]
+        obs_list = [observer.ObserverContext(d, self.lat, self.lon, 46.5) for d in dates]
+        ans = sun_object.SunObject().get_az_el_bulk(obs_list, -90.0)
+        self.assertEqual(len(ans), len(dates))
+        for d, cat in zip(dates, ans):
+            ra, dec = sun.Sun().radec(d)
+            _el, _az = self.loc.equatorial_to_horizontal(d, ra, dec)
+            self.assertEqual(len(cat.el), 1)
+            self.assertAlmostEqual(cat.el[0], _el.to_degrees(), places=9)
+            self.assertAlmostEqual(cat.az[0], _az.to_degrees(), places=9)
+
+    def load(self, name_list=None, text=TLE):
+        fd, path = tempfile.mkstemp(suffix='.tle')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        try:
+            return norad_cache.Sp4Ephemerides(path, 1.5e6, name_list)
+        finally:
+            os.remove(path)
+
+    def test_name_list(self):
+        self.assertEqual(list(self.load(['DECAYED']).names), ['DECAYED'])
+        self.assertEqual(list(self.load([]).names), [])
+
+    def test_malformed_file(self):
+        lines = TLE.splitlines()
+        # Misaligned by a leading blank line, with the right number of lines
+        with self.assertRaises(ValueError):
+            self.load(text="\n".join([''] + lines[:-1]))
+        # Line 1 and line 2 of different satellites
+        with self.assertRaises(ValueError):
+            self.load(text="\n".join(lines[0:2] + [lines[5], lines[3], lines[4], lines[2]]))
+        with self.assertRaises(ValueError):
+            self.load(text="<html>\n<body>Too many requests</body>\n</html>\n")
+        with self.assertRaises(ValueError):
+            self.load(text="")
+
+    def test_errored_satellite(self):
+        eph = self.load()
+
+        e, pos, vel = eph.propagate(self.obs.jd, self.obs.fr)
+        self.assertEqual(list(e), [0, 1])
+
+        ans = eph.get_az_el(self.obs, -90.0).to_list()
+        self.assertEqual([sv['name'] for sv in ans], ['GPS BIIR 0 (PRN 00)'])
+
+        bulk = eph.get_az_el_bulk([self.obs, self.obs], -90.0)
+        self.assertEqual([len(cat) for cat in bulk], [1, 1])
+
+        names, ecef, vel, jy = eph.get_positions_batch(DATE)
+        self.assertEqual(names, ['GPS BIIR 0 (PRN 00)'])
+
+
+if __name__ == '__main__':
+    unittest.main()